@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+# Benchmark of the /watchstats computations with the largest watchlist
+# allowed (50 symbols) and 3 years of daily bars (750 bars per symbol)
+
+import timeit
+import numpy as np
+import pandas as pd
+from tickergram.tickergram import watchlist_stats, correlation_pairs
+
+def synthetic_closes(n_tickers=50, n_bars=750, seed=0):
+    rng = np.random.default_rng(seed)
+    rets = rng.normal(0.0005, 0.02, size=(n_bars, n_tickers))
+    closes = 100 * np.cumprod(1 + rets, axis=0)
+    # Leave some gaps like tickers listed later or missing bars
+    closes[:100, 0] = np.nan
+    closes[rng.random(closes.shape) < 0.01] = np.nan
+    index = pd.bdate_range(end="2021-12-31", periods=n_bars)
+    columns = ["T{:02d}".format(i) for i in range(n_tickers)]
+    return pd.DataFrame(closes, index=index, columns=columns)
+
+def run(closes):
+    stats, corr = watchlist_stats(closes)
+    return stats, correlation_pairs(corr)
+
+def main():
+    closes = synthetic_closes()
+    number = 20
+    elapsed = min(timeit.repeat(lambda: run(closes), number=number, repeat=5)) / number
+    print("watchstats 50x750 bars: {:.2f} ms".format(elapsed*1000))
+
+if __name__ == "__main__":
+    main()
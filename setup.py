@@ -37,6 +37,7 @@ setup(
     install_requires=read_requirements("requirements.txt"),
     entry_points={
         "console_scripts": ["tickergram-bot=tickergram.tickergram:main",
-            "tickergram-notify=tickergram.tickergram:notify_watchers"]
+            "tickergram-notify=tickergram.tickergram:notify_watchers",
+            "tickergram-stream=tickergram.tickergram:stream_quotes"]
     },
 )
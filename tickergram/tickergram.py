@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
-import time, sys, os, uuid, tempfile, re, subprocess, json, logging, datetime, multiprocessing, threading, argparse, shutil, concurrent.futures
+import time, sys, os, uuid, tempfile, re, subprocess, json, logging, datetime, multiprocessing, threading, argparse, shutil, concurrent.futures, bisect, csv, hashlib, io, queue, cProfile, pstats, random, glob, signal
 import requests
+import numpy as np
+import pandas as pd
 import yfinance as yf
 import mplfinance as mpf
 import redis
@@ -10,8 +12,156 @@ import plotly.graph_objects as plotly_go
 import locale
 locale.setlocale(locale.LC_ALL, "en_US.utf8")
 
+def watchlist_stats(closes):
+    # closes is a DataFrame of daily close prices with one column per ticker,
+    # NaN where a ticker didn't trade. Returns a DataFrame with the period
+    # return, annualized volatility and max drawdown (all in %) per ticker,
+    # and the correlation matrix of daily returns
+    # Daily returns against the previous valid close of each ticker, so
+    # days where only some tickers traded (e.g. crypto weekends) are skipped
+    rets = closes / closes.ffill().shift(1) - 1
+    first = closes.bfill().iloc[0]
+    last = closes.ffill().iloc[-1]
+    stats = pd.DataFrame({
+        "return": (last / first - 1) * 100,
+        "volatility": rets.std() * np.sqrt(252) * 100,
+        "max_drawdown": (closes / closes.cummax() - 1).min() * 100,
+        })
+    return stats, rets.corr()
+
+def correlation_pairs(corr):
+    # Returns the (ticker, ticker, correlation) pairs of the upper triangle
+    # of the correlation matrix, sorted from most to least correlated
+    tickers = corr.columns.to_numpy()
+    i, j = np.triu_indices(len(tickers), k=1)
+    values = corr.to_numpy()[i, j]
+    valid = ~np.isnan(values)
+    i, j, values = i[valid], j[valid], values[valid]
+    order = np.argsort(-values, kind="stable")
+    return list(zip(tickers[i[order]], tickers[j[order]], values[order]))
+
+class symbol_index:
+    # In-memory prefix index of symbols and company names, loaded from a
+    # CSV file with "symbol,name" rows. Lookups are binary searches over
+    # sorted lists of keys, each key pointing to a position in self.symbols
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.lock = threading.Lock()
+        self.symbols = []
+        self.names = []
+        self.symbol_keys = []
+        self.symbol_refs = []
+        self.name_keys = []
+        self.name_refs = []
+        self.reload()
+
+    def reload(self):
+        mtime = os.stat(self.path).st_mtime
+        symbols, names, symbol_keys, name_keys = [], [], [], []
+        seen = set()
+        with open(self.path, newline="", encoding="utf8") as f:
+            for row in csv.reader(f):
+                if len(row) < 2 or not row[0].strip() or row[0].startswith("#"):
+                    continue
+                # Symbols are used as inline result ids, which must be unique
+                symbol = row[0].strip().upper()
+                if symbol in seen:
+                    continue
+                seen.add(symbol)
+                i = len(symbols)
+                symbols.append(symbol)
+                names.append(row[1].strip())
+                symbol_keys.append((symbols[i].lower(), i))
+                for w in set(names[i].lower().split()):
+                    name_keys.append((w, i))
+        symbol_keys.sort()
+        name_keys.sort()
+        with self.lock:
+            self.symbols, self.names = symbols, names
+            self.symbol_keys = [k for k, _ in symbol_keys]
+            self.symbol_refs = [i for _, i in symbol_keys]
+            self.name_keys = [k for k, _ in name_keys]
+            self.name_refs = [i for _, i in name_keys]
+            self.mtime = mtime
+
+    def reload_if_changed(self):
+        try:
+            if os.stat(self.path).st_mtime != self.mtime:
+                self.reload()
+                return True
+        except OSError:
+            pass
+        return False
+
+    def prefix_refs(self, keys, refs, prefix):
+        i = bisect.bisect_left(keys, prefix)
+        while i < len(keys) and keys[i].startswith(prefix):
+            yield refs[i]
+            i += 1
+
+    def search(self, query, limit=20):
+        # Symbol prefix matches go first, then company name word matches
+        query = query.strip().lower()
+        if not query:
+            return []
+        with self.lock:
+            symbols, names = self.symbols, self.names
+            symbol_keys, symbol_refs = self.symbol_keys, self.symbol_refs
+            name_keys, name_refs = self.name_keys, self.name_refs
+        ret, seen = [], set()
+        words = query.split()
+        for ref in self.prefix_refs(symbol_keys, symbol_refs, query):
+            if len(ret) >= limit:
+                break
+            seen.add(ref)
+            ret.append((symbols[ref], names[ref]))
+        for ref in self.prefix_refs(name_keys, name_refs, words[0]):
+            if len(ret) >= limit:
+                break
+            if ref in seen:
+                continue
+            # Every other query word must also prefix a word of the name
+            name_words = names[ref].lower().split()
+            if all(any(nw.startswith(w) for nw in name_words) for w in words[1:]):
+                seen.add(ref)
+                ret.append((symbols[ref], names[ref]))
+        return ret
+
+class replay_feed:
+    # Stand-in for the streaming price feed (yf.WebSocket) that replays
+    # messages recorded in a JSON lines file, for testing
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self.symbols = set()
+
+    def subscribe(self, symbols):
+        self.symbols.update(symbols)
+
+    def unsubscribe(self, symbols):
+        self.symbols.difference_update(symbols)
+
+    def close(self):
+        pass
+
+    def listen(self, message_handler):
+        prev_time = None
+        with open(self.path, encoding="utf8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                msg = json.loads(line)
+                # Keep the original pace of the feed using the message timestamps (ms)
+                msg_time = int(msg.get("time", 0)) / 1000
+                if prev_time and msg_time > prev_time and self.speed > 0:
+                    time.sleep((msg_time - prev_time) / self.speed)
+                prev_time = msg_time
+                if msg.get("id") in self.symbols:
+                    message_handler(msg)
+
 class tickergram:
-    def __init__(self, tg_token, redis_host, redis_port, redis_db, password="", allow_commands=[]):
+    def __init__(self, tg_token, redis_host, redis_port, redis_db, password="", allow_commands=[], symbols_file="", admin_chats=[]):
         # Configuration
         self.BOT_PASSWORD = password
         self.BOT_ENABLED_PASS = True if password else False
@@ -19,9 +169,52 @@ class tickergram:
         self.REDIS_PORT = redis_port
         self.REDIS_DB = redis_db
         self.ALLOW_COMMANDS = allow_commands
+        self.ADMIN_CHATS = admin_chats
         self.TG_API="https://api.telegram.org/bot" + tg_token
         self.MAX_CHART_RANGE = datetime.timedelta(days=3*365) # 3 years
+        # Price history cache expiration (secs) per bar interval, 0 disables the cache
+        self.HISTORY_CACHE_EXPIRE = {"1H": 0, "1D": 300, "1W": 3600, "1M": 3600}
         self.POLLING_TIMEOUT = 600
+        self.OVERVIEW_TICKERS = ["#Stocks ETFs", "SPY", "QQQ",
+                "FEZ", "MCHI", "VNQ", "#VIX", "^VIX",
+                "#10Y Bonds", "^TNX", "#Gold", "GC=F",
+                "#Crypto", "BTC-USD"]
+        # Live messages (/watchlist live, /overview live)
+        self.LIVE_REFRESH_SECS = 60
+        self.LIVE_TTL_SECS = 3600 # 1 hour
+        # Command scheduling, each class has its own queue and number of workers.
+        # Commands waiting longer than the deadline (secs) are answered with a
+        # busy message instead of being executed
+        self.CMD_CLASSES = {
+                "light": {"workers": 8, "deadline": 30, "queue_size": 200}, # /quote, /watch, /watchlistnotify
+                "normal": {"workers": 4, "deadline": 60, "queue_size": 100}, # /news, /watchlist, /overview
+                "heavy": {"workers": 2, "deadline": 90, "queue_size": 20}, # /chart, /feargreed, /watchstats
+                }
+        self.CMD_TIMEOUT = 600
+        self.cmd_queues = {}
+        # Streaming quotes (tickergram-stream)
+        self.HOT_TICKERS_SECS = 3600 # tickers requested during the last hour
+        self.STREAM_RESUBSCRIBE_SECS = 300
+        self.STREAM_RECONNECT_SECS = 5
+        self.STREAM_RECONNECT_MAX_SECS = 300
+        # Watchlist notifications, chat validity is cached for CHAT_VALID_TTL
+        # secs and refreshed in batches by the bot in the background
+        self.CHAT_VALID_TTL = 86400 # 1 day
+        self.CHAT_VALID_REFRESH_SECS = 3600
+        self.CHAT_VALID_BATCH = 20
+        self.NOTIFY_RETRIES = 3
+        self.NOTIFY_BACKOFF_SECS = 2
+        # Profiling of sampled commands (/profile), the sampling rate
+        # is kept in Redis and read at most every PROFILE_RATE_SECS
+        self.PROFILE_DIR = os.path.join(tempfile.gettempdir(), "tickergram_profiles")
+        self.PROFILE_RATE_SECS = 10
+        self.profile_rate = 0
+        self.profile_rate_time = 0
+        self.PROFILE_MAX_RUNS = 200
+        self.profile_threads = None # profilers of the pool threads of a sampled run
+        # Inline queries (@bot <symbol or name>)
+        self.SYMBOLS_FILE = symbols_file
+        self.symbol_index = None
         # Configure logging
         self.logger = logging.getLogger("tickergram_log")
         self.logger.setLevel(logging.DEBUG)
@@ -61,11 +254,50 @@ class tickergram:
             return False
         return d
 
-    def tg_chat_exists(self, chat_id):
+    def tg_edit_msg_post(self, text, chat_id, message_id):
+        d = {"chat_id": chat_id, "message_id": message_id, "text": text, "parse_mode": "MarkdownV2", "disable_web_page_preview": True}
+        r = requests.post(self.TG_API+"/editMessageText", params=d, timeout=30)
+        # Returns the API response even if it's not ok, used to classify errors
+        try:
+            return r.json()
+        except ValueError:
+            return {"ok": False, "error_code": r.status_code}
+
+    def tg_send_msg_post_raw(self, text, chat_id):
+        # Returns the API response even if it's not ok, used to classify errors
+        d = {"chat_id": chat_id, "text": text, "parse_mode": "MarkdownV2", "disable_web_page_preview": True}
+        r = requests.post(self.TG_API+"/sendMessage", params=d, timeout=30)
+        try:
+            return r.json()
+        except ValueError:
+            return {"ok": False, "error_code": r.status_code}
+
+    def tg_get_chat(self, chat_id):
         d = {"chat_id": chat_id}
-        r = requests.get(self.TG_API+"/getChat", params=d)
-        d = r.json()
-        return d.get("ok", False)
+        r = requests.get(self.TG_API+"/getChat", params=d, timeout=30)
+        try:
+            return r.json()
+        except ValueError:
+            return {"ok": False, "error_code": r.status_code}
+
+    def tg_classify_error(self, d):
+        # Classifies a failed API response (None if the request itself failed)
+        # as "permanent" (the chat can't be reached anymore), "transient" (it may
+        # work later) or "failed" (other errors, e.g. a malformed message).
+        # Returns the error class and the secs to wait before retrying, if known
+        if not d:
+            return "transient", None
+        code = d.get("error_code", 0)
+        if code == 429:
+            return "transient", d.get("parameters", {}).get("retry_after")
+        if code >= 500:
+            return "transient", None
+        desc = d.get("description", "").lower()
+        if code in (400, 403) and any(e in desc for e in ("chat not found", "bot was blocked", "bot was kicked",
+                "user is deactivated", "group chat was upgraded", "not enough rights", "have no rights",
+                "message to edit not found", "message can't be edited")):
+            return "permanent", None
+        return "failed", None
 
     def tg_delete_msg(self, tg_message):
         d = {"chat_id": tg_message["chat"]["id"], "message_id": tg_message["message_id"]}
@@ -84,7 +316,7 @@ class tickergram:
         return d
 
     def tg_get_messages(self, offset=0, limit=1):
-        d = {"timeout": self.POLLING_TIMEOUT, "allowed_updates": ["message"], "limit": limit}
+        d = {"timeout": self.POLLING_TIMEOUT, "allowed_updates": json.dumps(["message", "edited_message", "inline_query"]), "limit": limit}
         if offset:
             d["offset"] = offset
         r = requests.get(self.TG_API+"/getUpdates", params=d, timeout=self.POLLING_TIMEOUT+30)
@@ -93,6 +325,14 @@ class tickergram:
             raise RuntimeError("tg_get_messages not ok")
         return d
 
+    def tg_answer_inline_query(self, inline_query_id, results):
+        d = {"inline_query_id": inline_query_id, "results": json.dumps(results), "cache_time": 60}
+        r = requests.post(self.TG_API+"/answerInlineQuery", data=d)
+        d = r.json()
+        if not d["ok"]:
+            raise RuntimeError("tg_answer_inline_query not ok")
+        return d
+
     def tg_send_action(self, chat_id, action="typing"):
         d = {"chat_id": chat_id, "action": action}
         r = requests.post(self.TG_API+"/sendChatAction", data=d)
@@ -175,10 +415,116 @@ class tickergram:
         d = self.redis_get_db().get("quote_"+ticker)
         return json.loads(d) if d else None
 
+    def redis_get_quotes_cache(self, tickers):
+        d = self.redis_get_db().mget(["quote_"+t for t in tickers])
+        return [json.loads(q) if q else None for q in d]
+
     def redis_set_quote_cache(self, ticker, ticker_data):
         r = self.redis_get_db()
         r.setex("quote_"+ticker, 300, json.dumps(ticker_data)) # 5 min exp
 
+    def redis_set_live_msg(self, chat_id, kind, message_id, text):
+        # Only one live message per chat and kind, a new one replaces the old one
+        r = self.redis_get_db()
+        r.hset("live_msgs", "{}_{}".format(chat_id, kind), json.dumps({"chat_id": chat_id, "kind": kind,
+            "message_id": message_id, "text": text, "expire": time.time()+self.LIVE_TTL_SECS}))
+
+    def redis_update_live_msg_text(self, live_msg, text):
+        live_msg["text"] = text
+        r = self.redis_get_db()
+        r.hset("live_msgs", "{}_{}".format(live_msg["chat_id"], live_msg["kind"]), json.dumps(live_msg))
+
+    def redis_del_live_msg(self, live_msg):
+        r = self.redis_get_db()
+        r.hdel("live_msgs", "{}_{}".format(live_msg["chat_id"], live_msg["kind"]))
+
+    def redis_list_live_msgs(self):
+        r = self.redis_get_db()
+        return [json.loads(m) for m in r.hvals("live_msgs")]
+
+    def redis_get_history_cache(self, ticker, time_range, interval):
+        d = self.redis_get_db().get("hist_{}_{}_{}".format(ticker, time_range, interval))
+        if not d:
+            return None
+        d = json.loads(d)
+        hist = pd.read_json(io.StringIO(d["hist"]), orient="split", dtype=False)
+        # Dates are stored in UTC, restore the timezone of the exchange
+        if d["tz"]:
+            hist.index = hist.index.tz_convert(d["tz"])
+        return hist
+
+    def redis_set_history_cache(self, ticker, time_range, interval, hist, expire):
+        r = self.redis_get_db()
+        tz = str(hist.index.tz) if hist.index.tz is not None else None
+        r.setex("hist_{}_{}_{}".format(ticker, time_range, interval), expire,
+                json.dumps({"tz": tz, "hist": hist.to_json(orient="split", date_format="iso")}))
+
+    def redis_get_watchstats_cache(self, wl_hash):
+        d = self.redis_get_db().get("watchstats_"+wl_hash)
+        return d.decode() if d else None
+
+    def redis_set_watchstats_cache(self, wl_hash, text_msg):
+        r = self.redis_get_db()
+        r.setex("watchstats_"+wl_hash, 86400, text_msg) # 1 day exp
+
+    def redis_add_sched_stats(self, cmd_class, wait_time, shed):
+        # Lua script so concurrent workers update the max wait time atomically
+        script = """
+            redis.call("HINCRBY", KEYS[1], ARGV[1] .. "_jobs", 1)
+            redis.call("HINCRBYFLOAT", KEYS[1], ARGV[1] .. "_wait_total", ARGV[2])
+            if ARGV[3] == "1" then
+                redis.call("HINCRBY", KEYS[1], ARGV[1] .. "_shed", 1)
+            end
+            local wait_max = redis.call("HGET", KEYS[1], ARGV[1] .. "_wait_max")
+            if not wait_max or tonumber(wait_max) < tonumber(ARGV[2]) then
+                redis.call("HSET", KEYS[1], ARGV[1] .. "_wait_max", ARGV[2])
+            end
+            """
+        r = self.redis_get_db()
+        r.eval(script, 1, "sched_stats", cmd_class, repr(wait_time), "1" if shed else "0")
+
+    def redis_add_sched_rejected(self, cmd_class):
+        r = self.redis_get_db()
+        r.hincrby("sched_stats", "{}_rejected".format(cmd_class), 1)
+
+    def redis_touch_hot_ticker(self, ticker):
+        r = self.redis_get_db()
+        r.zadd("hot_tickers", {ticker: time.time()})
+
+    def redis_list_hot_tickers(self):
+        r = self.redis_get_db()
+        r.zremrangebyscore("hot_tickers", "-inf", time.time()-self.HOT_TICKERS_SECS)
+        return [t.decode() for t in r.zrange("hot_tickers", 0, -1)]
+
+    def redis_list_watched_tickers(self):
+        r = self.redis_get_db()
+        wl_keys = [k for k in r.scan_iter("wl_*") if k != b"wl_enabled" and not k.endswith(b"_info")]
+        return [t.decode() for t in r.sunion(wl_keys)] if wl_keys else []
+
+    def redis_get_profile_rate(self):
+        d = self.redis_get_db().get("profile_rate")
+        return float(d) if d else 0
+
+    def redis_set_profile_rate(self, rate):
+        r = self.redis_get_db()
+        r.set("profile_rate", rate)
+
+    def redis_get_chats_valid(self, chat_ids):
+        # Returns True, False or None (unknown) for each chat
+        d = self.redis_get_db().mget(["chat_valid_{}".format(c) for c in chat_ids])
+        return [None if v is None else v == b"1" for v in d]
+
+    def redis_set_chat_valid(self, chat_id, valid):
+        r = self.redis_get_db()
+        r.setex("chat_valid_{}".format(chat_id), self.CHAT_VALID_TTL, "1" if valid else "0")
+
+    def redis_get_chat_valid_ttl(self, chat_id):
+        return self.redis_get_db().ttl("chat_valid_{}".format(chat_id))
+
+    def redis_set_notify_report(self, report):
+        r = self.redis_get_db()
+        r.set("notify_report", json.dumps(report))
+
     def test_tg_or_die(self):
         self.logger.info("Checking Telegram API token ...")
         if not self.tg_getme():
@@ -234,6 +580,27 @@ class tickergram:
         text_msg += "\n```"
         return text_msg
 
+    def text_quote_long_info(self, t, ticker_info):
+        short_name = ticker_info["company_name"]
+        price = ticker_info["latest_price"]
+        price_prevclose = ticker_info["previous_close"]
+        ftweek_high = ticker_info["52w_high"]
+        ftweek_low = ticker_info["52w_low"]
+        day_high = ticker_info["day_high"]
+        day_low = ticker_info["day_low"]
+        volume = ticker_info["market_volume"]
+        volume_avg = ticker_info["market_volume_avg"]
+        pe = ticker_info["pe_trailing"]
+        pe_forward = ticker_info["pe_forward"]
+        div_yield = ticker_info["div_yield"]
+        # Get price changes
+        price_change = self.get_change(price, price_prevclose)
+        ftweek_high_chg = self.get_change(price, ftweek_high)
+        ftweek_low_chg = self.get_change(price, ftweek_low)
+        # Compose message text
+        return self.text_quote_long(t, short_name, price, price_prevclose, price_change, ftweek_high, ftweek_high_chg, ftweek_low, ftweek_low_chg,
+                day_low, day_high, volume, volume_avg, pe, pe_forward, div_yield)
+
     def text_quote_short(self, t, price, price_prevclose, price_change, ftweek_high, ftweek_high_chg):
         price_change_sign = "+" if price >= price_prevclose else "-"
         if price_change > 1:
@@ -246,11 +613,81 @@ class tickergram:
                 price, price_change_sign, price_change, price_change_emoji, ftweek_high_chg_sign, ftweek_high_chg, ftweek_high_chg_emoji)
         return text_msg
 
+    def text_quote_short_info(self, t, ticker_info):
+        price = ticker_info["latest_price"]
+        price_prevclose = ticker_info["previous_close"]
+        ftweek_high = ticker_info["52w_high"]
+        # Get price changes
+        price_change = self.get_change(price, price_prevclose)
+        ftweek_high_chg = self.get_change(price, ftweek_high)
+        return self.text_quote_short(t, price, price_prevclose, price_change, ftweek_high, ftweek_high_chg)
+
+    def text_watchlist(self, wl_tickers, quotes):
+        # wl_tickers is a list of str, quotes a dict of quotes indexed by ticker
+        if not wl_tickers:
+            return "```\nYour watchlist is empty\n```"
+        text_msg = ""
+        for t in wl_tickers:
+            ticker_info = quotes.get(t)
+            if not ticker_info:
+                continue
+            text_msg += self.text_quote_short_info(t, ticker_info)
+        # Telegram rejects messages without text
+        if not text_msg:
+            return "```\nError getting ticker info\n```"
+        return "```\n" + text_msg + "```"
+
+    def text_overview(self, quotes):
+        # Raises an exception if any of the overview quotes is missing
+        text_msg = "```\n"
+        for t in self.OVERVIEW_TICKERS:
+            if t.startswith("#"): # Parse sections
+                if len(t) > 1:
+                    text_msg += "----- {}\n".format(t[1:])
+                else:
+                    text_msg += "-----\n"
+                continue
+            text_msg += self.text_quote_short_info(t, quotes[t])
+        text_msg += "```"
+        return text_msg
+
+    def text_watchstats(self, stats, corr, time_range, missing_tickers):
+        text_msg = "```\n"
+        text_msg += "Watchlist {} stats\n".format(time_range)
+        text_msg += "{:<10} {:>8} {:>7} {:>8}\n".format("Symbol", "Return", "Vol", "Max DD")
+        for t, row in stats.iterrows():
+            text_msg += "{:<10} {:>+7.2f}% {:>6.2f}% {:>7.2f}%\n".format(t, row["return"], row["volatility"], row["max_drawdown"])
+        pairs = correlation_pairs(corr)
+        if pairs:
+            # Show both ends of the sorted pairs without repeating them
+            top = min(5, (len(pairs)+1)//2)
+            text_msg += "----- Most correlated\n"
+            for a, b, c in pairs[:top]:
+                text_msg += "{}/{} {:.2f}\n".format(a, b, c)
+            if len(pairs) > top:
+                text_msg += "----- Least correlated\n"
+                for a, b, c in pairs[-min(top, len(pairs)-top):]:
+                    text_msg += "{}/{} {:.2f}\n".format(a, b, c)
+        if missing_tickers:
+            text_msg += "-----\nNo data for {}\n".format(", ".join(missing_tickers))
+        text_msg += "```"
+        return text_msg
+
+    def overview_tickers(self):
+        return [t for t in self.OVERVIEW_TICKERS if not t.startswith("#")]
+
     def generic_get_quote(self, ticker):
         # Easily replace the quote provider here, using the same standard
         # output format used in yf_get_quote
         return self.yf_get_quote(ticker)
 
+    def generic_get_quotes(self, tickers):
+        # Fetch several quotes concurrently, returns a dict indexed by ticker
+        # (tickers without a valid quote are set to None)
+        tickers = list(set(tickers))
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            return dict(zip(tickers, executor.map(self.bot_profile_wrap(self.generic_get_quote), tickers)))
+
     def generic_get_news(self, ticker):
         # Easily replace the data provider here, using the same standard
         # output format used in yf_get_news
@@ -292,23 +729,90 @@ class tickergram:
         self.redis_set_quote_cache(ticker, ret_data)
         return ret_data
 
-    def yf_get_stock_chart(self, ticker, time_range="1Y", interval="1D"):
+    def yf_get_stock_history(self, ticker, time_range="1Y", interval="1D"):
+        # Get history cache before querying YF
+        if self.HISTORY_CACHE_EXPIRE.get(interval, 0):
+            hist = self.redis_get_history_cache(ticker, time_range, interval)
+            if hist is not None:
+                return hist
         # Make YF range and interval formats compatible
-        time_range = time_range.replace("M", "MO")
-        interval = interval.replace("W", "WK")
-        interval = interval.replace("M", "MO")
+        yf_time_range = time_range.replace("M", "MO")
+        yf_interval = interval.replace("W", "WK")
+        yf_interval = yf_interval.replace("M", "MO")
+        t = yf.Ticker(ticker)
+        hist = t.history(period=yf_time_range, interval=yf_interval)
+        expire = self.HISTORY_CACHE_EXPIRE.get(interval, 0)
+        if expire and not hist.empty:
+            self.redis_set_history_cache(ticker, time_range, interval, hist, expire)
+        return hist
+
+    def yf_get_stock_chart(self, ticker, time_range="1Y", interval="1D"):
         output_file = "{}.png".format(str(uuid.uuid4()))
         try:
-            t = yf.Ticker(ticker)
-            hist = t.history(period=time_range, interval=interval)
+            hist = self.yf_get_stock_history(ticker, time_range, interval)
             mpf.plot(hist, type="candle", volume=True, style="mike", datetime_format='%b %Y',
                     figratio=(20,10), tight_layout=True,
-                    title="\n{} {}".format(ticker, time_range),
+                    title="\n{} {}".format(ticker, time_range.replace("M", "MO")),
                     savefig=dict(fname=output_file, dpi=95))
         except:
             pass
         return output_file
 
+    def yf_get_closes(self, tickers, time_range="1Y"):
+        # Returns a DataFrame of daily close prices with one column per ticker,
+        # tickers without data are left out
+        def get_close(t):
+            try:
+                hist = self.yf_get_stock_history(t, time_range, "1D")
+            except:
+                return None
+            if hist.empty:
+                return None
+            close = hist["Close"].copy()
+            # Align bars from different exchanges and timezones by date
+            if close.index.tz is not None:
+                close.index = close.index.tz_localize(None)
+            close.index = close.index.normalize()
+            return close
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            closes = dict(zip(tickers, executor.map(self.bot_profile_wrap(get_close), tickers)))
+        closes = {t: c for t, c in closes.items() if c is not None}
+        if not closes:
+            return pd.DataFrame()
+        return pd.concat(closes, axis=1).sort_index()
+
+    def yf_stream_update_quote(self, msg, create=False):
+        # Update the quote cache with a message from the streaming feed.
+        # Only cached quotes are updated, the rest of fields (PE ratio,
+        # volume average...) come from the last yf_get_quote query.
+        # With create, missing quotes are created with the fields available
+        # in the message (used to replay recorded feeds without querying YF)
+        ticker = msg.get("id")
+        if not ticker or not msg.get("price"):
+            return False
+        price = round(float(msg["price"]), 2)
+        ticker_data = self.redis_get_quote_cache(ticker)
+        if not ticker_data:
+            if not create:
+                return False
+            ticker_data = {"company_name": msg.get("short_name", ticker), "latest_price": price, "previous_close": price,
+                    "52w_high": price, "52w_low": price, "day_high": price, "day_low": price,
+                    "market_volume": "N/A", "market_volume_avg": "N/A", "pe_trailing": "N/A",
+                    "pe_forward": "N/A", "div_yield": "N/A"}
+        ticker_data["latest_price"] = price
+        if msg.get("previous_close"):
+            ticker_data["previous_close"] = round(float(msg["previous_close"]), 2)
+        if msg.get("day_high"):
+            ticker_data["day_high"] = round(float(msg["day_high"]), 2)
+        if msg.get("day_low"):
+            ticker_data["day_low"] = round(float(msg["day_low"]), 2)
+        if msg.get("day_volume"):
+            ticker_data["market_volume"] = f'{int(msg["day_volume"]):n}'
+        ticker_data["52w_high"] = max(ticker_data["52w_high"], price)
+        ticker_data["52w_low"] = min(ticker_data["52w_low"], price)
+        self.redis_set_quote_cache(ticker, ticker_data)
+        return True
+
     def yf_get_news(self, ticker):
         try:
             ty = yf.Ticker(ticker)
@@ -405,34 +909,65 @@ class tickergram:
     def valid_ticker(self, ticker):
         return True if len(ticker) <= 10 and re.fullmatch(r"^[A-Za-z0-9\.\^\-]{1,10}$", ticker) else False
 
-    def bot_watchlist_notify_thread(self, chat_id):
-        if not self.tg_chat_exists(int(chat_id)):
+    def bot_deliver_msg(self, text_msg, chat_id):
+        # Sends a message retrying transient errors with exponential backoff.
+        # Returns the delivery status ("sent" or an error class from
+        # tg_classify_error) and the number of attempts
+        for attempt in range(1, self.NOTIFY_RETRIES+2):
+            try:
+                d = self.tg_send_msg_post_raw(text_msg, chat_id)
+            except requests.exceptions.RequestException:
+                d = None
+            if d and d.get("ok"):
+                return "sent", attempt
+            status, retry_after = self.tg_classify_error(d)
+            if status != "transient" or attempt > self.NOTIFY_RETRIES:
+                return status, attempt
+            # Don't stall the notify run on long flood control waits
+            max_wait = self.NOTIFY_BACKOFF_SECS * 2**self.NOTIFY_RETRIES
+            if retry_after and retry_after > max_wait:
+                return status, attempt
+            time.sleep(retry_after or self.NOTIFY_BACKOFF_SECS * 2**(attempt-1))
+
+    def bot_watchlist_notify_thread(self, chat_id, chat_valid=None):
+        report = {"chat_id": chat_id, "status": "empty", "attempts": 0, "latency": 0}
+        if chat_valid is False:
             # Chat doesn't exist anymore, disable automatic notifications for this watchlist
             self.redis_watch_disable(chat_id)
             self.logger.warning("Telegram chat id {} does not exist, automatic notifications disabled".format(chat_id))
-            return False
-        wl_tickers = self.redis_list_user_watch(chat_id)
+            report["status"] = "invalid"
+            return report
+        wl_tickers = [t.decode() for t in self.redis_list_user_watch(chat_id)]
         if not wl_tickers:
-            return False
-        text_msg = "```\n"
-        for t in wl_tickers:
-            t = t.decode()
-            ticker_info = self.generic_get_quote(t)
-            if not ticker_info:
-                continue
-            price = ticker_info["latest_price"]
-            price_prevclose = ticker_info["previous_close"]
-            ftweek_high = ticker_info["52w_high"]
-            # Get price changes
-            price_change = self.get_change(price, price_prevclose)
-            ftweek_high_chg = self.get_change(price, ftweek_high)
-            # Compose message text
-            text_msg += self.text_quote_short(t, price, price_prevclose, price_change, ftweek_high, ftweek_high_chg)
-        text_msg += "```"
-        if not self.tg_send_msg_post(text_msg, chat_id):
-            # Error delivering message, disable automatic notifications for this watchlist
+            return report
+        text_msg = self.text_watchlist(wl_tickers, {t: self.generic_get_quote(t) for t in wl_tickers})
+        start_time = time.time()
+        report["status"], report["attempts"] = self.bot_deliver_msg(text_msg, chat_id)
+        report["latency"] = round(time.time() - start_time, 3)
+        if report["status"] == "sent":
+            self.redis_set_chat_valid(chat_id, True)
+        elif report["status"] == "permanent":
+            # Chat can't be reached anymore, disable automatic notifications for this watchlist
+            self.redis_set_chat_valid(chat_id, False)
             self.redis_watch_disable(chat_id)
             self.logger.warning("Telegram chat id {} could not send message, automatic notifications disabled".format(chat_id))
+        else:
+            self.logger.warning("Telegram chat id {} could not send message after {} attempts ({})".format(chat_id,
+                report["attempts"], report["status"]))
+        return report
+
+    def bot_watchlist_notify_report(self, reports, duration):
+        counts = {}
+        for r in reports:
+            counts[r["status"]] = counts.get(r["status"], 0) + 1
+        latencies = sorted(r["latency"] for r in reports if r["status"] == "sent")
+        report = {"time": int(time.time()), "duration": round(duration, 3), "chats": len(reports), "counts": counts,
+                "retried": sum(1 for r in reports if r["attempts"] > 1),
+                "latency_avg": round(sum(latencies)/len(latencies), 3) if latencies else 0,
+                "latency_p50": latencies[len(latencies)//2] if latencies else 0,
+                "latency_max": latencies[-1] if latencies else 0}
+        self.logger.info("Watchlist notify report: {}".format(json.dumps(report)))
+        return report
 
     def bot_watchlist_notify(self, chat_id=None):
         if chat_id:
@@ -443,12 +978,153 @@ class tickergram:
             self.test_tg_or_die()
             self.test_redis_or_die()
             watchlists = self.redis_list_enabled_watchlists()
+        watchlists = [c.decode() if type(c) is not str else c for c in watchlists]
+        if not watchlists:
+            return
+        # Chats are validated with the cache only, chats not found in the
+        # cache are validated by the delivery of the message itself
+        chats_valid = self.redis_get_chats_valid(watchlists) if not chat_id else [None]
+        start_time = time.time()
         # Execute watchlist notify function in different threads
         # to improve performance fetching quotes and sending messages
         with concurrent.futures.ThreadPoolExecutor() as executor:
-            for chat_id in watchlists:
-                chat_id = chat_id.decode() if type(chat_id) is not str else chat_id
-                executor.submit(self.bot_watchlist_notify_thread, chat_id)
+            futures = [executor.submit(self.bot_profile_wrap(self.bot_watchlist_notify_thread), c, v) for c, v in zip(watchlists, chats_valid)]
+        reports = []
+        for f in futures:
+            try:
+                reports.append(f.result())
+            except Exception as e:
+                self.logger.error("Error notifying watchlist: {}".format(e))
+                reports.append({"status": "error", "attempts": 0, "latency": 0})
+        if not chat_id:
+            self.redis_set_notify_report(self.bot_watchlist_notify_report(reports, time.time() - start_time))
+
+    def bot_chat_valid_check(self, chat_id):
+        try:
+            d = self.tg_get_chat(int(chat_id))
+        except requests.exceptions.RequestException:
+            return
+        if d.get("ok"):
+            self.redis_set_chat_valid(chat_id, True)
+        elif self.tg_classify_error(d)[0] == "permanent":
+            self.redis_set_chat_valid(chat_id, False)
+
+    def bot_chat_valid_refresh(self):
+        # Validate the chats with notifications enabled whose cache entry is
+        # missing or about to expire, in batches to avoid hitting rate limits
+        chat_ids = [c.decode() for c in self.redis_list_enabled_watchlists()]
+        chat_ids = [c for c in chat_ids if self.redis_get_chat_valid_ttl(c) < self.CHAT_VALID_REFRESH_SECS*2]
+        for i in range(0, len(chat_ids), self.CHAT_VALID_BATCH):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.CHAT_VALID_BATCH) as executor:
+                executor.map(self.bot_chat_valid_check, chat_ids[i:i+self.CHAT_VALID_BATCH])
+            time.sleep(1)
+        if chat_ids:
+            self.logger.info("Validated {} chats with watchlist notifications".format(len(chat_ids)))
+
+    def bot_chat_valid_refresh_loop(self):
+        while True:
+            try:
+                self.bot_chat_valid_refresh()
+            except Exception as e:
+                self.logger.error("Error refreshing chat validity: {}".format(e))
+            time.sleep(self.CHAT_VALID_REFRESH_SECS)
+
+    def bot_live_msg_text(self, live_msg, quotes):
+        if live_msg["kind"] == "watchlist":
+            wl_tickers = [t.decode() for t in self.redis_list_user_watch(live_msg["chat_id"])]
+            return self.text_watchlist(wl_tickers, quotes)
+        return self.text_overview(quotes)
+
+    def bot_live_refresh(self):
+        now = time.time()
+        live_msgs = []
+        for m in self.redis_list_live_msgs():
+            if m["expire"] < now:
+                self.redis_del_live_msg(m)
+            else:
+                live_msgs.append(m)
+        if not live_msgs:
+            return
+        # Fetch the quotes of all live messages in a single batch
+        tickers = set()
+        for m in live_msgs:
+            if m["kind"] == "watchlist":
+                tickers.update(t.decode() for t in self.redis_list_user_watch(m["chat_id"]))
+            else:
+                tickers.update(self.overview_tickers())
+        quotes = self.generic_get_quotes(tickers)
+        for m in live_msgs:
+            try:
+                text_msg = self.bot_live_msg_text(m, quotes)
+            except Exception as e:
+                self.logger.error("Error rendering live message: {}".format(e))
+                continue
+            # Only edit the message if its content changed
+            if text_msg == m["text"]:
+                continue
+            try:
+                d = self.tg_edit_msg_post(text_msg, m["chat_id"], m["message_id"])
+            except requests.exceptions.RequestException as e:
+                self.logger.error("Error editing live message: {}".format(e))
+                continue
+            if d.get("ok") or "message is not modified" in d.get("description", ""):
+                self.redis_update_live_msg_text(m, text_msg)
+            elif self.tg_classify_error(d)[0] == "permanent":
+                # Message deleted or not editable anymore, stop refreshing it
+                self.redis_del_live_msg(m)
+                self.logger.warning("Telegram chat id {} live message could not be edited, refresh stopped".format(m["chat_id"]))
+            else:
+                # Keep the message, the edit is retried on the next refresh
+                self.logger.warning("Telegram chat id {} live message could not be edited: {}".format(m["chat_id"], d.get("description", d.get("error_code"))))
+
+    def bot_live_refresh_loop(self):
+        while True:
+            time.sleep(self.LIVE_REFRESH_SECS)
+            try:
+                self.bot_live_refresh()
+            except Exception as e:
+                self.logger.error("Error refreshing live messages: {}".format(e))
+
+    def bot_live_msg_send(self, text_msg, chat_id, kind):
+        d = self.tg_send_msg_post(text_msg, chat_id)
+        if d:
+            self.redis_set_live_msg(chat_id, kind, d["result"]["message_id"], text_msg)
+
+    def bot_load_symbol_index(self):
+        if not self.SYMBOLS_FILE:
+            return
+        self.logger.info("Loading symbols file {} ...".format(self.SYMBOLS_FILE))
+        try:
+            self.symbol_index = symbol_index(self.SYMBOLS_FILE)
+        except Exception as e:
+            self.logger.error("Unable to load symbols file, inline queries disabled: {}".format(e))
+            return
+        self.logger.info("Loaded {} symbols".format(len(self.symbol_index.symbols)))
+
+    def bot_inline_query(self, inline_query):
+        # Only cached quotes are used here, inline queries are sent
+        # while the user types and must be answered quickly
+        results = []
+        if self.symbol_index:
+            if self.symbol_index.reload_if_changed():
+                self.logger.info("Symbols file reloaded, {} symbols".format(len(self.symbol_index.symbols)))
+            matches = self.symbol_index.search(inline_query["query"])
+            quotes = self.redis_get_quotes_cache([t for t, _ in matches]) if matches else []
+            for (t, name), ticker_info in zip(matches, quotes):
+                r = {"type": "article", "id": t, "title": "{} {}".format(t, name)}
+                if ticker_info:
+                    price = ticker_info["latest_price"]
+                    price_prevclose = ticker_info["previous_close"]
+                    price_change_sign = "+" if price >= price_prevclose else "-"
+                    r["description"] = "{:.2f} ({}{:.2f}%)".format(price, price_change_sign, self.get_change(price, price_prevclose))
+                    r["input_message_content"] = {"message_text": self.text_quote_long_info(t, ticker_info), "parse_mode": "MarkdownV2"}
+                else:
+                    r["input_message_content"] = {"message_text": "/quote {}".format(t)}
+                results.append(r)
+        try:
+            self.tg_answer_inline_query(inline_query["id"], results)
+        except Exception as e:
+            self.logger.error("Error answering inline query: {}".format(e))
 
     def bot_auth_chat(self, chat):
         return self.redis_check_chat_auth(chat["id"])
@@ -469,9 +1145,10 @@ class tickergram:
         text_msg += "/chart *\<symbol\> \[1y,6m,5d\]* get price and volume chart\n"
         text_msg += "/news *\<symbol\>* get the latest news related to the symbol\n"
         text_msg += "/watch *list\|add\|del* *\[symbol\]* list, add or remove symbol from your watchlist\n"
-        text_msg += "/watchlist get an overview of your watchlist\n"
+        text_msg += "/watchlist *\[live\]* get an overview of your watchlist, live updates it periodically\n"
+        text_msg += "/watchstats get 1 year returns, volatility, max drawdown and top/bottom correlated pairs of your watchlist\n"
         text_msg += "/watchlistnotify toggle the automatic watchlist notifications on and off\n"
-        text_msg += "/overview get an overview of global markets\n"
+        text_msg += "/overview *\[live\]* get an overview of global markets, live updates it periodically\n"
         text_msg += "/feargreed get picture of CNN's Fear & Greed Index\n\n"
         text_msg += u"_Powered by [Tickergram](https://github.com/a0rtega/tickergram-bot)_"
         self.tg_send_msg_post(text_msg, chat["id"])
@@ -491,25 +1168,9 @@ class tickergram:
             self.tg_start_action(chat["id"])
             ticker_info = self.generic_get_quote(ticker)
             if ticker_info:
-                short_name = ticker_info["company_name"]
-                price = ticker_info["latest_price"]
-                price_prevclose = ticker_info["previous_close"]
-                ftweek_high = ticker_info["52w_high"]
-                ftweek_low = ticker_info["52w_low"]
-                day_high = ticker_info["day_high"]
-                day_low = ticker_info["day_low"]
-                volume = ticker_info["market_volume"]
-                volume_avg = ticker_info["market_volume_avg"]
-                pe = ticker_info["pe_trailing"]
-                pe_forward = ticker_info["pe_forward"]
-                div_yield = ticker_info["div_yield"]
-                # Get price changes
-                price_change = self.get_change(price, price_prevclose)
-                ftweek_high_chg = self.get_change(price, ftweek_high)
-                ftweek_low_chg = self.get_change(price, ftweek_low)
-                # Compose message text
-                text_msg = self.text_quote_long(ticker, short_name, price, price_prevclose, price_change, ftweek_high, ftweek_high_chg, ftweek_low, ftweek_low_chg,
-                        day_low, day_high, volume, volume_avg, pe, pe_forward, div_yield)
+                # Keep track of requested tickers to stream their quotes
+                self.redis_touch_hot_ticker(ticker)
+                text_msg = self.text_quote_long_info(ticker, ticker_info)
             else:
                 text_msg = "```\nError getting ticker info\n```"
         else:
@@ -569,18 +1230,83 @@ class tickergram:
 
     def bot_cmd_watchlist(self, chat, text, msg_from):
         self.tg_start_action(chat["id"])
-        if not self.redis_list_user_watch(chat["id"]):
+        wl_tickers = [t.decode() for t in self.redis_list_user_watch(chat["id"])]
+        if not wl_tickers:
             text_msg = "```\nYour watchlist is empty\n```"
             self.tg_send_msg_post(text_msg, chat["id"])
+        elif text.endswith(" live"):
+            text_msg = self.text_watchlist(wl_tickers, self.generic_get_quotes(wl_tickers))
+            self.bot_live_msg_send(text_msg, chat["id"], "watchlist")
         else:
             self.bot_watchlist_notify(chat["id"])
 
+    def bot_cmd_watchstats(self, chat, text, msg_from):
+        wl_tickers = [t.decode() for t in self.redis_list_user_watch(chat["id"])]
+        if not wl_tickers:
+            text_msg = "```\nYour watchlist is empty\n```"
+            self.tg_send_msg_post(text_msg, chat["id"])
+            return
+        # Cache results per watchlist content and trading day
+        wl_hash = hashlib.sha1("{}_{}".format(",".join(wl_tickers),
+            datetime.datetime.now().strftime("%Y-%m-%d")).encode()).hexdigest()
+        text_msg = self.redis_get_watchstats_cache(wl_hash)
+        if not text_msg:
+            self.tg_start_action(chat["id"])
+            try:
+                closes = self.yf_get_closes(wl_tickers, "1Y")
+                if closes.empty:
+                    raise RuntimeError("watchstats no data")
+                stats, corr = watchlist_stats(closes)
+                missing_tickers = [t for t in wl_tickers if t not in closes.columns]
+                text_msg = self.text_watchstats(stats, corr, "1Y", missing_tickers)
+                self.redis_set_watchstats_cache(wl_hash, text_msg)
+            except Exception as e:
+                self.logger.error(str(e))
+                text_msg = "```\nError\n```"
+        self.tg_send_msg_post(text_msg, chat["id"])
+
     def bot_cmd_watchlistnotify(self, chat, text, msg_from):
         status = self.redis_watch_toggle(chat["id"])
+        if status:
+            # The chat is reachable, clear any cached delivery failure
+            self.redis_set_chat_valid(chat["id"], True)
         status = "enabled" if status else "disabled"
         text_msg = "```\nWatchlist notifications are now {}\n```".format(status)
         self.tg_send_msg_post(text_msg, chat["id"])
 
+    def bot_cmd_profile(self, chat, text, msg_from):
+        cmd = text.replace("/profile ", "").split(" ")
+        if cmd[0] == "on" and len(cmd) <= 2:
+            try:
+                rate = float(cmd[1]) if len(cmd) == 2 else 0.1
+            except ValueError:
+                rate = 0
+            if 0 < rate <= 1:
+                self.redis_set_profile_rate(rate)
+                text_msg = "```\nProfiling enabled for {:.0%} of commands\n```".format(rate)
+            else:
+                text_msg = "```\nInvalid sampling rate\n```"
+        elif cmd[0] == "off":
+            self.redis_set_profile_rate(0)
+            text_msg = "```\nProfiling disabled\n```"
+        elif cmd[0] == "top":
+            runs, top = self.bot_profile_top()
+            if runs:
+                text_msg = "```\n"
+                text_msg += "Profiled runs: {}\n".format(", ".join("{} {}".format(c, n) for c, n in sorted(runs.items())))
+                text_msg += "{:>9} {:>9} {:>7} function\n".format("tottime", "cumtime", "calls")
+                for f, line, func, nc, tt, ct in top:
+                    text_msg += "{:>8.2f}s {:>8.2f}s {:>7} {}:{}({})\n".format(tt, ct, nc, f, line, func)
+                text_msg += "```"
+            else:
+                text_msg = "```\nNo profiles available\n```"
+        elif cmd[0] == "reset":
+            shutil.rmtree(self.PROFILE_DIR, ignore_errors=True)
+            text_msg = "```\nProfiles removed\n```"
+        else:
+            text_msg = "```\nInvalid profile command\n```"
+        self.tg_send_msg_post(text_msg, chat["id"])
+
     def bot_cmd_chart(self, chat, text, msg_from):
         request = text.replace("/chart ", "").split(" ")
         ticker = request[0].upper()
@@ -622,34 +1348,18 @@ class tickergram:
             self.tg_send_msg_post(text_msg, chat["id"])
 
     def bot_cmd_overview(self, chat, text, msg_from):
-        global_tickers = ["#Stocks ETFs", "SPY", "QQQ",
-                "FEZ", "MCHI", "VNQ", "#VIX", "^VIX",
-                "#10Y Bonds", "^TNX", "#Gold", "GC=F",
-                "#Crypto", "BTC-USD"]
         self.tg_start_action(chat["id"])
         try:
-            text_msg = "```\n"
-            for t in global_tickers:
-                if t.startswith("#"): # Parse sections
-                    if len(t) > 1:
-                        text_msg += "----- {}\n".format(t[1:])
-                    else:
-                        text_msg += "-----\n"
-                    continue
-                ticker_info = self.generic_get_quote(t)
-                price = ticker_info["latest_price"]
-                price_prevclose = ticker_info["previous_close"]
-                ftweek_high = ticker_info["52w_high"]
-                # Get price changes
-                price_change = self.get_change(price, price_prevclose)
-                ftweek_high_chg = self.get_change(price, ftweek_high)
-                # Compose message text
-                text_msg += self.text_quote_short(t, price, price_prevclose, price_change, ftweek_high, ftweek_high_chg)
-            text_msg += "```"
+            text_msg = self.text_overview(self.generic_get_quotes(self.overview_tickers()))
         except Exception as e:
             self.logger.error(str(e))
             text_msg = "```\nError\n```"
-        self.tg_send_msg_post(text_msg, chat["id"])
+            self.tg_send_msg_post(text_msg, chat["id"])
+            return
+        if text.endswith(" live"):
+            self.bot_live_msg_send(text_msg, chat["id"], "overview")
+        else:
+            self.tg_send_msg_post(text_msg, chat["id"])
 
     def bot_cmd_feargreed(self, chat, text, msg_from):
         self.tg_start_action(chat["id"], "upload_photo")
@@ -661,14 +1371,152 @@ class tickergram:
             text_msg = "```\nError\n```"
             self.tg_send_msg_post(text_msg, chat["id"])
 
-    def bot_cmd_handler(self, fnc, chat, text, msg_from):
-        p = multiprocessing.Process(target=fnc, args=(chat, text, msg_from))
-        p.daemon = True
-        p.start()
+    def bot_profile_rate(self):
+        # Cached to avoid querying Redis for every command
+        if time.time() - self.profile_rate_time > self.PROFILE_RATE_SECS:
+            try:
+                self.profile_rate = self.redis_get_profile_rate()
+            except Exception as e:
+                self.logger.error("Error getting profile rate: {}".format(e))
+            self.profile_rate_time = time.time()
+        return self.profile_rate
+
+    def bot_profile_wrap(self, fnc):
+        # cProfile only records the thread that enables it, functions run on
+        # thread pools during a sampled run are wrapped to profile them as well.
+        # Returns fnc unchanged when the command isn't being profiled
+        if self.profile_threads is None:
+            return fnc
+        profile_threads = self.profile_threads
+        def profiled_fnc(*args, **kwargs):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Python 3.12+ profiles all the threads with a single profiler
+                # (sys.monitoring), the handler profiler already covers this one
+                return fnc(*args, **kwargs)
+            try:
+                return fnc(*args, **kwargs)
+            finally:
+                profiler.disable()
+                profile_threads.append(profiler)
+        return profiled_fnc
+
+    def bot_cmd_profiled(self, fnc, chat, text, msg_from):
+        # Runs the command handler under cProfile, including the thread pools
+        # it uses (see bot_profile_wrap). Each run is saved to its own file in
+        # PROFILE_DIR, keeping the latest PROFILE_MAX_RUNS runs
+        profiler = cProfile.Profile()
+        self.profile_threads = []
+        try:
+            profiler.runcall(fnc, chat, text, msg_from)
+        finally:
+            stats = pstats.Stats(profiler)
+            for p in self.profile_threads:
+                stats.add(p)
+            self.profile_threads = None
+            os.makedirs(self.PROFILE_DIR, exist_ok=True)
+            profile_file = os.path.join(self.PROFILE_DIR, "{}_{}.prof".format(fnc.__name__, uuid.uuid4()))
+            # Write to a temporary file first to never leave truncated profiles
+            stats.dump_stats(profile_file + ".tmp")
+            os.replace(profile_file + ".tmp", profile_file)
+            files = sorted(glob.glob(os.path.join(self.PROFILE_DIR, "*.prof")), key=os.path.getmtime)
+            for f in files[:-self.PROFILE_MAX_RUNS]:
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+
+    def bot_profile_top(self, n=15):
+        # Aggregates all the saved profiles, returns the number of profiled
+        # runs per command and the top functions by own time (tottime)
+        stats = None
+        runs = {}
+        for f in glob.glob(os.path.join(self.PROFILE_DIR, "*.prof")):
+            try:
+                if stats is None:
+                    stats = pstats.Stats(f)
+                else:
+                    stats.add(f)
+            except Exception as e:
+                self.logger.warning("Unable to load profile {}: {}".format(f, e))
+                continue
+            cmd = os.path.basename(f).rsplit("_", 1)[0]
+            runs[cmd] = runs.get(cmd, 0) + 1
+        if stats is None:
+            return {}, []
+        top = sorted(stats.stats.items(), key=lambda i: i[1][2], reverse=True)[:n]
+        return runs, [(os.path.basename(f), line, func, nc, tt, ct) for (f, line, func), (cc, nc, tt, ct, callers) in top]
+
+    def bot_cmd_busy(self, chat):
+        text_msg = "```\nThe bot is busy, try again later\n```"
+        try:
+            self.tg_send_msg_post(text_msg, chat["id"])
+        except Exception as e:
+            self.logger.error("Error sending busy message: {}".format(e))
+
+    def bot_cmd_worker(self, cmd_class):
+        # Executes the commands of a class one at a time, each on its own process
+        deadline = self.CMD_CLASSES[cmd_class]["deadline"]
+        q = self.cmd_queues[cmd_class]
+        while True:
+            fnc, chat, text, msg_from, queued_time = q.get()
+            wait_time = time.time() - queued_time
+            shed = wait_time > deadline
+            try:
+                self.redis_add_sched_stats(cmd_class, wait_time, shed)
+            except Exception as e:
+                self.logger.error("Error saving scheduler stats: {}".format(e))
+            self.logger.debug("Command {} ({}) waited {:.2f}s".format(fnc.__name__, cmd_class, wait_time))
+            if shed:
+                self.logger.warning("Command {} ({}) dropped after waiting {:.2f}s".format(fnc.__name__, cmd_class, wait_time))
+                self.bot_cmd_busy(chat)
+                continue
+            target, args = fnc, (chat, text, msg_from)
+            profile_rate = self.bot_profile_rate()
+            if profile_rate and random.random() < profile_rate:
+                target, args = self.bot_cmd_profiled, (fnc, chat, text, msg_from)
+            p = multiprocessing.Process(target=target, args=args)
+            p.daemon = True
+            p.start()
+            p.join(self.CMD_TIMEOUT)
+            if p.is_alive():
+                self.logger.error("Command {} ({}) timed out, terminating".format(fnc.__name__, cmd_class))
+                p.terminate()
+
+    def bot_start_workers(self):
+        for cmd_class, conf in self.CMD_CLASSES.items():
+            self.cmd_queues[cmd_class] = queue.Queue(maxsize=conf["queue_size"])
+            for _ in range(conf["workers"]):
+                t = threading.Thread(target=self.bot_cmd_worker, args=(cmd_class,))
+                t.daemon = True
+                t.start()
+
+    def bot_cmd_handler(self, fnc, chat, text, msg_from, cmd_class="normal"):
+        try:
+            self.cmd_queues[cmd_class].put_nowait((fnc, chat, text, msg_from, time.time()))
+        except queue.Full:
+            self.logger.warning("Command {} ({}) dropped, queue is full".format(fnc.__name__, cmd_class))
+            try:
+                self.redis_add_sched_rejected(cmd_class)
+            except Exception as e:
+                self.logger.error("Error saving scheduler stats: {}".format(e))
+            self.bot_cmd_busy(chat)
 
     def bot_loop(self):
         self.test_tg_or_die()
         self.test_redis_or_die()
+        self.bot_load_symbol_index()
+        self.bot_start_workers()
+        # Refresh live messages in the background
+        t = threading.Thread(target=self.bot_live_refresh_loop)
+        t.daemon = True
+        t.start()
+        # Refresh the chat validity cache used by watchlist notifications
+        t = threading.Thread(target=self.bot_chat_valid_refresh_loop)
+        t.daemon = True
+        t.start()
         # Disable pidfile creation to allow multiple bot instances
         #self.logger.info("Bot is running with pid {}".format(self.write_pidfile()))
         last_update_id = 0
@@ -680,6 +1528,18 @@ class tickergram:
                 time.sleep(30)
                 continue
             for m in msgs["result"]:
+                if "inline_query" in m.keys():
+                    last_update_id = m["update_id"] + 1
+                    inline_query = m["inline_query"]
+                    # Private chat ids match user ids, so users that authorized
+                    # their private chat can use inline queries
+                    if (self.BOT_ENABLED_PASS and "/quote" not in self.ALLOW_COMMANDS
+                            and not self.redis_check_chat_auth(inline_query["from"]["id"])):
+                        continue
+                    t = threading.Thread(target=self.bot_inline_query, args=(inline_query,))
+                    t.daemon = True
+                    t.start()
+                    continue
                 try:
                     update_id = m["update_id"]
                     # Support for telegram edited messages
@@ -718,9 +1578,11 @@ class tickergram:
                     self.bot_cmd_help(chat, text, msg_from)
                 elif self.BOT_ENABLED_PASS and text.startswith("/auth "):
                     self.bot_cmd_auth(chat, text, msg_from)
+                elif chat["id"] in self.ADMIN_CHATS and text.startswith("/profile "):
+                    self.bot_cmd_handler(self.bot_cmd_profile, chat, text, msg_from, "light")
                 else: # Authorized-only commands
                     if not chat_auth and text.split(" ")[0] in ("/quote", "/chart", "/news",
-                            "/watch", "/watchlist", "/watchlistnotify",
+                            "/watch", "/watchlist", "/watchstats", "/watchlistnotify",
                             "/overview", "/feargreed"):
                         text_msg = "```\nUnauthorized\n```"
                         if self.ALLOW_COMMANDS:
@@ -729,24 +1591,124 @@ class tickergram:
                             text_msg += "Type /help for more information"
                         self.tg_send_msg_post(text_msg, chat["id"])
                     elif chat_auth and text.startswith("/quote "):
-                        self.bot_cmd_handler(self.bot_cmd_quote, chat, text, msg_from)
+                        self.bot_cmd_handler(self.bot_cmd_quote, chat, text, msg_from, "light")
                     elif chat_auth and text.startswith("/chart "):
-                        self.bot_cmd_handler(self.bot_cmd_chart, chat, text, msg_from)
+                        self.bot_cmd_handler(self.bot_cmd_chart, chat, text, msg_from, "heavy")
                     elif chat_auth and text.startswith("/news "):
-                        self.bot_cmd_handler(self.bot_cmd_news, chat, text, msg_from)
+                        self.bot_cmd_handler(self.bot_cmd_news, chat, text, msg_from, "normal")
                     elif chat_auth and text.startswith("/watch "):
-                        self.bot_cmd_handler(self.bot_cmd_watch, chat, text, msg_from)
-                    elif chat_auth and text == "/watchlist":
-                        self.bot_cmd_handler(self.bot_cmd_watchlist, chat, text, msg_from)
+                        self.bot_cmd_handler(self.bot_cmd_watch, chat, text, msg_from, "light")
+                    elif chat_auth and text in ("/watchlist", "/watchlist live"):
+                        self.bot_cmd_handler(self.bot_cmd_watchlist, chat, text, msg_from, "normal")
+                    elif chat_auth and text == "/watchstats":
+                        self.bot_cmd_handler(self.bot_cmd_watchstats, chat, text, msg_from, "heavy")
                     elif chat_auth and text == "/watchlistnotify":
-                        self.bot_cmd_handler(self.bot_cmd_watchlistnotify, chat, text, msg_from)
-                    elif chat_auth and text == "/overview":
-                        self.bot_cmd_handler(self.bot_cmd_overview, chat, text, msg_from)
+                        self.bot_cmd_handler(self.bot_cmd_watchlistnotify, chat, text, msg_from, "light")
+                    elif chat_auth and text in ("/overview", "/overview live"):
+                        self.bot_cmd_handler(self.bot_cmd_overview, chat, text, msg_from, "normal")
                     elif chat_auth and text == "/feargreed":
-                        self.bot_cmd_handler(self.bot_cmd_feargreed, chat, text, msg_from)
+                        self.bot_cmd_handler(self.bot_cmd_feargreed, chat, text, msg_from, "heavy")
                 # Increase update id
                 last_update_id = update_id + 1
 
+    def bot_stream_tickers(self):
+        return set(self.redis_list_watched_tickers()) | set(self.redis_list_hot_tickers()) | set(self.overview_tickers())
+
+    def bot_stream_subscribe_loop(self, stream):
+        while True:
+            try:
+                tickers = self.bot_stream_tickers()
+                # Prime the quote cache, streamed messages only update cached quotes
+                if not stream["replay"]:
+                    self.generic_get_quotes(tickers)
+                with stream["lock"]:
+                    subscribed = stream["subscribed"]
+                    new_tickers, old_tickers = tickers - subscribed, subscribed - tickers
+                    if new_tickers:
+                        stream["feed"].subscribe(sorted(new_tickers))
+                    if old_tickers:
+                        stream["feed"].unsubscribe(sorted(old_tickers))
+                    subscribed.clear()
+                    subscribed.update(tickers)
+                self.logger.info("Streaming quotes of {} tickers".format(len(tickers)))
+            except Exception as e:
+                self.logger.error("Error updating stream subscriptions: {}".format(e))
+            time.sleep(self.STREAM_RESUBSCRIBE_SECS)
+
+    def bot_stream_reconnect(self, stream):
+        # Replace the feed with a new connection subscribed to the same tickers,
+        # the feed is only replaced once the subscription succeeded
+        with stream["lock"]:
+            try:
+                stream["feed"].close()
+            except Exception:
+                pass
+            feed = yf.WebSocket(verbose=False)
+            if stream["subscribed"]:
+                feed.subscribe(sorted(stream["subscribed"]))
+            stream["feed"] = feed
+
+    def bot_stream_quotes(self, replay_file="", replay_speed=1.0, record_file=""):
+        self.test_redis_or_die()
+        if replay_file:
+            feed = replay_feed(replay_file, replay_speed)
+        else:
+            feed = yf.WebSocket(verbose=False)
+        stream = {"feed": feed, "subscribed": set(), "lock": threading.Lock(), "replay": bool(replay_file)}
+        record_f = open(record_file, "a", encoding="utf8") if record_file else None
+        def message_handler(msg):
+            if record_f:
+                record_f.write(json.dumps(msg) + "\n")
+                record_f.flush()
+            try:
+                self.yf_stream_update_quote(msg, create=stream["replay"])
+            except Exception as e:
+                self.logger.error("Error updating streamed quote {}: {}".format(msg, e))
+        # Subscriptions are refreshed in the background to follow watchlists and hot tickers
+        t = threading.Thread(target=self.bot_stream_subscribe_loop, args=(stream,))
+        t.daemon = True
+        t.start()
+        # Wait for the first subscription before listening
+        while not stream["subscribed"] and t.is_alive():
+            time.sleep(1)
+        # yf.WebSocket.listen returns both when the connection fails and on
+        # KeyboardInterrupt, keep track of Ctrl-C to tell them apart
+        def stop_handler(signum, frame):
+            stream["stop"] = True
+            raise KeyboardInterrupt
+        stream["stop"] = False
+        signal.signal(signal.SIGINT, stop_handler)
+        backoff = self.STREAM_RECONNECT_SECS
+        try:
+            while True:
+                listen_time = time.time()
+                try:
+                    stream["feed"].listen(message_handler)
+                except Exception as e:
+                    self.logger.error("Error listening to the stream: {}".format(e))
+                if replay_file or stream["stop"]:
+                    # The recorded messages were replayed or the user stopped it
+                    break
+                # The connection failed, reconnect with exponential backoff
+                # (reset if the connection lasted a while)
+                if time.time() - listen_time > self.STREAM_RECONNECT_MAX_SECS:
+                    backoff = self.STREAM_RECONNECT_SECS
+                while not stream["stop"]:
+                    self.logger.warning("Stream connection lost, reconnecting in {}s".format(backoff))
+                    time.sleep(backoff)
+                    backoff = min(backoff*2, self.STREAM_RECONNECT_MAX_SECS)
+                    try:
+                        self.bot_stream_reconnect(stream)
+                        break
+                    except Exception as e:
+                        self.logger.error("Error reconnecting to the stream: {}".format(e))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stream["feed"].close()
+            if record_f:
+                record_f.close()
+
 def main():
     parser = argparse.ArgumentParser(description="Tickergram bot")
     parser.add_argument("token", help="Telegram Bot API token", nargs=1)
@@ -756,9 +1718,13 @@ def main():
     parser.add_argument("-r", "--redis", default="localhost", help="redis host to use")
     parser.add_argument("-l", "--port", type=int, default=6379, help="redis port to use")
     parser.add_argument("-d", "--db", type=int, default=0, help="redis database to use")
+    parser.add_argument("-s", "--symbols", default="", help="CSV file with symbol,name rows used to answer inline queries (reloaded when modified)")
+    parser.add_argument("-A", "--admin", default="", help="Chat ids allowed to use admin commands (/profile), comma-separated list",
+            type=lambda s: [int(i) for i in s.split(",")] if s else [])
     args = parser.parse_args()
 
-    b = tickergram(args.token[0], redis_host=args.redis, redis_port=args.port, redis_db=args.db, password=args.password, allow_commands=args.allow)
+    b = tickergram(args.token[0], redis_host=args.redis, redis_port=args.port, redis_db=args.db, password=args.password, allow_commands=args.allow,
+            symbols_file=args.symbols, admin_chats=args.admin)
     b.bot_loop()
 
 def notify_watchers():
@@ -772,6 +1738,19 @@ def notify_watchers():
     b = tickergram(args.token[0], redis_host=args.redis, redis_port=args.port, redis_db=args.db)
     b.bot_watchlist_notify()
 
+def stream_quotes():
+    parser = argparse.ArgumentParser(description="Tickergram quote streaming. Subscribes to a streaming price feed for the watched and recently requested tickers and keeps their quote cache up to date.")
+    parser.add_argument("-r", "--redis", default="localhost", help="redis host to use")
+    parser.add_argument("-l", "--port", type=int, default=6379, help="redis port to use")
+    parser.add_argument("-d", "--db", type=int, default=0, help="redis database to use")
+    parser.add_argument("--replay", default="", help="replay the feed messages recorded in this file instead of connecting to the live feed")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier, 0 replays without delays")
+    parser.add_argument("--record", default="", help="append the received feed messages to this file")
+    args = parser.parse_args()
+
+    b = tickergram("", redis_host=args.redis, redis_port=args.port, redis_db=args.db)
+    b.bot_stream_quotes(replay_file=args.replay, replay_speed=args.speed, record_file=args.record)
+
 if __name__ == "__main__":
     main()
 